@@ -4,9 +4,57 @@ from collections import Counter
 import os
 import cv2
 import torch
+import torch.nn as nn
 import pandas as pd
 
 
+def uses_flattened_head(model_state_dict):
+    """
+    Check whether a checkpoint was trained with the original flattened Linear head.
+
+    Args:
+    - model_state_dict (dict): State dict loaded from a checkpoint file.
+
+    Returns:
+    - bool: True if the first Linear layer takes the flattened feature maps.
+    """
+    return '5.weight' in model_state_dict and model_state_dict['5.weight'].shape[1] != 15
+
+def rename_legacy_layers(model_state_dict):
+    """
+    Rename layer keys of flattened head checkpoints saved before the redundant ReLU after MaxPool2d was removed.
+
+    Those checkpoints stored the two Linear layers at indices 5 and 7 of the Sequential model,
+    which are now at indices 4 and 6.
+
+    Args:
+    - model_state_dict (dict): State dict loaded from a checkpoint file.
+
+    Returns:
+    - dict: State dict with keys matching the current Sequential layout.
+    """
+    legacy_indices = {'5': '4', '7': '6'}
+    renamed_state_dict = {}
+    for k, v in model_state_dict.items():
+        index, param = k.split('.', 1)
+        renamed_state_dict[legacy_indices.get(index, index) + '.' + param] = v
+    return renamed_state_dict
+
+def quantize_for_checkpoint(cnn_model, model_state_dict):
+    """
+    Quantize the model's Linear layers if the checkpoint was saved from an int8 quantized model.
+
+    Args:
+    - cnn_model (nn.Module): Freshly constructed model.
+    - model_state_dict (dict): State dict loaded from a checkpoint file.
+
+    Returns:
+    - nn.Module: Model whose layers match the checkpoint.
+    """
+    if any(k.endswith('_packed_params') for k in model_state_dict):
+        return torch.ao.quantization.quantize_dynamic(cnn_model, {nn.Linear}, dtype=torch.qint8)
+    return cnn_model
+
 def load_train_model(model_path):
     """
     Load and return a trained TrainsCNN model from the specified file.
@@ -18,10 +66,14 @@ def load_train_model(model_path):
     - TrainsCNN: Loaded TrainsCNN model.
     """
     print(model_path)
-    cnn_model = TrainsCNN()
     model_state_dict = torch.load(model_path)
+    flattened_head = uses_flattened_head(model_state_dict)
+    cnn_model = TrainsCNN(global_pool=not flattened_head)
+    if flattened_head:
+        model_state_dict = rename_legacy_layers(model_state_dict)
     
     model_state_dict = {'model.' + k: v for k, v in model_state_dict.items()}
+    cnn_model = quantize_for_checkpoint(cnn_model, model_state_dict)
     cnn_model.load_state_dict(model_state_dict)
     return cnn_model
 
@@ -36,10 +88,14 @@ def load_station_model(model_path):
     - StationsCNN: Loaded StationsCNN model.
     """
     print(model_path)
-    cnn_model = StationsCNN()
     model_state_dict2 = torch.load(model_path)
+    flattened_head = uses_flattened_head(model_state_dict2)
+    cnn_model = StationsCNN(global_pool=not flattened_head)
+    if flattened_head:
+        model_state_dict2 = rename_legacy_layers(model_state_dict2)
     
     model_state_dict = {'model.' + k: v for k, v in model_state_dict2.items()}
+    cnn_model = quantize_for_checkpoint(cnn_model, model_state_dict)
     cnn_model.load_state_dict(model_state_dict)
 
     return cnn_model
@@ -1,13 +1,14 @@
 import torch
 import numpy as np
 import torch.nn as nn
+import torch.multiprocessing as mp
 from torch.utils.data import Dataset, DataLoader
-from torch.optim import Adam
+from torch.optim import AdamW
 import matplotlib.pyplot as plt
-from torchvision import transforms
 from torch.utils.data import random_split
 import time
-from scipy.ndimage import rotate
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 import cv2
@@ -17,16 +18,25 @@ import matplotlib.pyplot as plt
 class TrainsCNN(nn.Module):
     """Convolutional Neural Network for train spot image classification."""
 
-    def __init__(self):
-        """Initialize the CNN model."""
+    def __init__(self, global_pool=True):
+        """
+        Initialize the CNN model.
+
+        Args:
+        - global_pool (bool): Average pool the feature maps before the Linear head. Set to
+          False to build the original flattened head used by older checkpoints.
+        """
         super().__init__()
+        if global_pool:
+            head = [nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(15, 512)]
+        else:
+            head = [nn.Flatten(), nn.Linear(21960, 512)]
+
         self.model = nn.Sequential(
             nn.Conv2d(3, 15, kernel_size=3),
             nn.ReLU(),
             nn.MaxPool2d(2),
-            nn.ReLU(),
-            nn.Flatten(),
-            nn.Linear(21960, 512),
+            *head,
             nn.ReLU(),
             nn.Linear(512, 6)
         )
@@ -39,16 +49,25 @@ class TrainsCNN(nn.Module):
 class StationsCNN(nn.Module):
     """Convolutional Neural Network for station spot image classification."""
 
-    def __init__(self):
-        """Initialize the CNN model."""
+    def __init__(self, global_pool=True):
+        """
+        Initialize the CNN model.
+
+        Args:
+        - global_pool (bool): Average pool the feature maps before the Linear head. Set to
+          False to build the original flattened head used by older checkpoints.
+        """
         super().__init__()
+        if global_pool:
+            head = [nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(15, 512)]
+        else:
+            head = [nn.Flatten(), nn.Linear(36015, 512)]
+
         self.model = nn.Sequential(
             nn.Conv2d(3, 15, kernel_size=3),
             nn.ReLU(),
             nn.MaxPool2d(2),
-            nn.ReLU(),
-            nn.Flatten(),
-            nn.Linear(36015, 512),
+            *head,
             nn.ReLU(),
             nn.Linear(512, 6)
         )
@@ -61,24 +80,32 @@ class StationsCNN(nn.Module):
 class T2RDataset(Dataset):
     """Custom dataset class for Train/Station Spot images."""
 
-    def __init__(self, root_dir, transform, dtype):
+    # (height, width) images are resized to, and number of samples stored per image
+    image_sizes = {'station': (100, 100), 'train': (50, 125)}
+    samples_per_image = {'station': 4, 'train': 1}
+
+    def __init__(self, root_dir, transform, dtype, device='cpu'):
         """
         Initialize T2RDataset.
 
         Loads data from the specified root directory and sets up necessary attributes.
+        The images are converted once into a single normalized (N, 3, H, W) tensor on
+        the given device, so no per-sample conversion happens during training.
 
         Args:
         - root_dir (str): Root directory containing image folders.
         - transform (callable): Optional transform to be applied to images.
         - dtype (str): Type of data ('station' or 'train').
+        - device (str): Device to store the image and target tensors on. Default is 'cpu'.
         """
         self.root_dir = root_dir
-        self.data = []
-        self.targets = []
+        self.data = None
+        self.targets = None
         self.transform = transform
         self.color_mapping = {'blue': 1, 'black': 2, 'green': 3, 'red': 4, 'yellow': 5}
 
         self.load_data(dtype)
+        self.to_tensors(device)
 
     def load_data(self, dtype):
         """
@@ -88,50 +115,95 @@ class T2RDataset(Dataset):
         - dtype (str): Type of data ('station' or 'train').
         """
         big_folder = self.root_dir
-        for folder in os.listdir(big_folder):
-            if folder != '.DS_Store':
-                folder_path = os.path.join(big_folder, folder)
-                for filename in os.listdir(folder_path):
-                    if filename != '.DS_Store':
-                        img_path = os.path.join(folder_path, filename)
-                        original_image = cv2.imread(img_path)
-                        
-                        if dtype == 'station':
-                            self.load_station_image(original_image, filename)
-                        elif dtype == 'train':
-                            self.load_train_image(original_image, filename)
-
-
-    def load_station_image(self, original_image, filename):
+        paths = []
+        with os.scandir(big_folder) as folders:
+            for folder in folders:
+                if not folder.is_dir():
+                    continue
+                with os.scandir(folder.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(('.jpg', '.png')):
+                            paths.append((entry.path, entry.name))
+
+        height, width = self.image_sizes[dtype]
+        num_samples = len(paths) * self.samples_per_image[dtype]
+        self.data = np.empty((num_samples, 3, height, width), dtype=np.float16)
+        self.targets = np.empty(num_samples, dtype=np.int64)
+
+        # cv2 releases the GIL while decoding, so threads read images in parallel
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            images = executor.map(lambda path: (cv2.imread(path[0]), path[1]), paths)
+
+            for i, (original_image, filename) in enumerate(images):
+                index = i * self.samples_per_image[dtype]
+                if dtype == 'station':
+                    self.load_station_image(original_image, filename, index)
+                elif dtype == 'train':
+                    self.load_train_image(original_image, filename, index)
+
+
+    def to_tensors(self, device):
+        """
+        Convert the loaded images and targets into tensors stored on the device.
+
+        Images are kept in half precision on CUDA and converted to single precision on CPU.
+
+        Args:
+        - device (str): Device to store the tensors on.
+        """
+        images = torch.from_numpy(self.data)
+        if device != 'cuda':
+            images = images.float()
+        self.data = images.to(device)
+        self.targets = torch.from_numpy(self.targets).to(device)
+
+    def store_image(self, image, index):
+        """
+        Normalize an image and write it into the preallocated data array.
+
+        The uint8 HWC image is scaled to [-1, 1] in float16 and stored as CHW, matching
+        ToTensor followed by Normalize((0.5,), (0.5,)) in a single pass.
+
+        Args:
+        - image: Resized uint8 image.
+        - index (int): Row of the data array to write to.
+        """
+        self.data[index] = image.transpose(2, 0, 1).astype(np.float16) * (1.0 / 127.5) - 1.0
+
+    def load_station_image(self, original_image, filename, index):
         """
         Load and augment station images to increase training data.
 
+        Writes the resized image and its three quarter-turn rotations into
+        rows index to index + 3 of the preallocated data array.
+
         Args:
         - original_image: Original station image.
         - filename (str): Image filename.
+        - index (int): First row to write to.
         """
-        desired_height, desired_width = 100, 100
-        resized_image = cv2.resize(original_image, (desired_width, desired_height))
-        
-        for rotation_angle in [0, 90, 180, 270]:
-            rotated_image = rotate(resized_image, rotation_angle, reshape=False)
-            label = filename.split('-')[0]
-            self.data.append(rotated_image)
-            self.targets.append(self.color_mapping.get(label, 0))
+        desired_height, desired_width = self.image_sizes['station']
+        self.store_image(cv2.resize(original_image, (desired_width, desired_height)), index)
 
-    def load_train_image(self, original_image, filename):
+        label = filename.split('-')[0]
+        for k in range(1, 4):
+            # Quarter turns are exact, so no interpolation is needed
+            self.data[index + k] = np.rot90(self.data[index], k, axes=(1, 2))
+        self.targets[index:index + 4] = self.color_mapping.get(label, 0)
+
+    def load_train_image(self, original_image, filename, index):
         """
         Load and process train images.
 
         Args:
         - original_image: Original train image.
         - filename (str): Image filename.
+        - index (int): Row of the preallocated data array to write to.
         """
-        desired_height, desired_width = 50, 125
-        image = cv2.resize(original_image, (desired_width, desired_height))
+        desired_height, desired_width = self.image_sizes['train']
+        self.store_image(cv2.resize(original_image, (desired_width, desired_height)), index)
         label = filename.split('-')[0]
-        self.data.append(image)
-        self.targets.append(self.color_mapping.get(label, 0))
+        self.targets[index] = self.color_mapping.get(label, 0)
 
 
     def split_data(self, train_percentage=0.7):
@@ -203,9 +275,13 @@ class Classifier:
         self.dtype = dtype
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-        self.model = model.to(self.device)
-        self.optimizer = Adam(self.model.parameters(), lr=self.learning_rate)
+        self.model = model.to(self.device, memory_format=torch.channels_last)
+        if torch.cuda.is_available():
+            self.model = torch.compile(self.model, mode="reduce-overhead", fullgraph=True)
+        self.optimizer = AdamW(self.model.parameters(), lr=self.learning_rate, fused=torch.cuda.is_available())
         self.loss_func = nn.CrossEntropyLoss()
+        self.use_amp = self.device == 'cuda'
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
 
         self.train_dataset, self.train_loader, self.test_dataset, self.test_loader = self.load_data()
 
@@ -219,15 +295,11 @@ class Classifier:
         - test_dataset (Subset): Testing dataset.
         - test_loader (DataLoader): Testing data loader.
         """
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,))
-        ])
-
-        custom_dataset = T2RDataset(self.root_dir, transform=transform, dtype=self.dtype)
+        custom_dataset = T2RDataset(self.root_dir, transform=None, dtype=self.dtype, device=self.device)
         train_dataset, test_dataset = custom_dataset.split_data()
-        train_loader = DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True)
-        test_loader = DataLoader(test_dataset, batch_size=self.batch_size, shuffle=True)
+        # The dataset already lives on the device, so batches are gathered in-process
+        train_loader = DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=0)
+        test_loader = DataLoader(test_dataset, batch_size=self.batch_size, shuffle=True, num_workers=0)
 
         return train_dataset, train_loader, test_dataset, test_loader
 
@@ -240,14 +312,39 @@ class Classifier:
         - y: Target labels.
 
         Returns:
-        - float: Batch loss value.
+        - Tensor: Detached batch loss value.
+        - Tensor: Number of correct predictions, taken from the same forward pass.
         """
         self.model.train()
         self.optimizer.zero_grad()
-        batch_loss = self.loss_func(self.model(x), y)
-        batch_loss.backward()
-        self.optimizer.step()
-        return batch_loss.item()
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp):
+            prediction = self.model(x)
+            batch_loss = self.loss_func(prediction, y)
+        self.scaler.scale(batch_loss).backward()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        batch_correct = (prediction.argmax(dim=1) == y).sum()
+        return batch_loss.detach(), batch_correct
+
+    @torch.no_grad()
+    def evaluate_batch(self, x, y):
+        """
+        Evaluate the model on a batch of data without updating its weights.
+
+        Args:
+        - x: Input data.
+        - y: Target labels.
+
+        Returns:
+        - Tensor: Batch loss value.
+        - Tensor: Number of correct predictions.
+        """
+        self.model.eval()
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp):
+            prediction = self.model(x)
+            batch_loss = self.loss_func(prediction, y)
+        batch_correct = (prediction.argmax(dim=1) == y).sum()
+        return batch_loss, batch_correct
 
     @torch.no_grad()
     def accuracy(self, x, y):
@@ -262,7 +359,8 @@ class Classifier:
         - float: Batch accuracy.
         """
         self.model.eval()
-        prediction = self.model(x)
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp):
+            prediction = self.model(x)
         argmaxes = prediction.argmax(dim=1)
         s = torch.sum((argmaxes == y).float()) / len(y)
         return s.item()
@@ -280,28 +378,38 @@ class Classifier:
             print(f"Running epoch {epoch + 1} of {self.num_epochs}")
             start_time = time.time()
 
-            epoch_losses, epoch_accuracies = [], []
+            # Metrics are summed on the device and only synced with .item() once per epoch
+            running_loss = torch.zeros((), device=self.device)
+            running_correct = torch.zeros((), device=self.device)
+            n = 0
 
             for batch in self.train_loader:
                 x, y = batch
-                batch_loss = self.train_batch(x, y)
-                epoch_losses.append(batch_loss)
-                batch_acc = self.accuracy(x, y)
-                epoch_accuracies.append(batch_acc)
+                x = x.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+                y = y.to(self.device, non_blocking=True)
+                batch_loss, batch_correct = self.train_batch(x, y)
+                running_loss += batch_loss * x.size(0)
+                running_correct += batch_correct
+                n += x.size(0)
+
+            train_losses.append((running_loss / n).item())
+            train_accuracies.append((running_correct / n).item())
 
-            train_losses.append(np.mean(epoch_losses))
-            train_accuracies.append(np.mean(epoch_accuracies))
+            running_loss = torch.zeros((), device=self.device)
+            running_correct = torch.zeros((), device=self.device)
+            n = 0
 
-            epoch_test_accuracies, epoch_test_losses = [], []
-            for ix, batch in enumerate(iter(self.test_loader)):
+            for batch in self.test_loader:
                 x, y = batch
-                test_loss = self.train_batch(x, y)
-                test_acc = self.accuracy(x, y)
-                epoch_test_accuracies.append(test_acc)
-                epoch_test_losses.append(test_loss)
+                x = x.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+                y = y.to(self.device, non_blocking=True)
+                test_loss, test_correct = self.evaluate_batch(x, y)
+                running_loss += test_loss * x.size(0)
+                running_correct += test_correct
+                n += x.size(0)
 
-            test_losses.append(np.mean(epoch_test_losses))
-            test_accuracies.append(np.mean(epoch_test_accuracies))
+            test_losses.append((running_loss / n).item())
+            test_accuracies.append((running_correct / n).item())
 
             end_time = time.time()
             time_per_epoch.append(end_time - start_time)
@@ -324,9 +432,11 @@ class Classifier:
 
         images, labels = next(iter(loader))
 
-        images, labels = images.to(self.device), labels.to(self.device)
+        images = images.to(self.device, memory_format=torch.channels_last)
+        labels = labels.to(self.device)
 
-        outputs = self.model(images)
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.use_amp):
+            outputs = self.model(images)
         _, predicted = torch.max(outputs, 1)
 
         for i in range(num_images):
@@ -342,10 +452,18 @@ class Classifier:
         """
         Save the trained model to a file.
 
+        The Linear layers are dynamically quantized to int8 for smaller checkpoints and
+        faster CPU inference when scoring.
+
         Args:
         - save_path (str): File path to save the model.
         """
-        torch.save(self.model.state_dict(), save_path)
+        # A compiled model wraps the original module, whose keys are what the loaders expect
+        model = getattr(self.model, '_orig_mod', self.model)
+        quantized_model = torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(model).cpu(), {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        torch.save(quantized_model.state_dict(), save_path)
         print(f"Model saved at: {save_path}")
 
     def plot_results(self, results):
@@ -356,52 +474,71 @@ class Classifier:
             results (tuple): Tuple of training and testing results.
         """
         train_losses, train_accuracies, test_losses, test_accuracies, time_per_epoch = results
+        epochs = np.arange(1, len(train_losses) + 1)
         plt.figure(figsize=(15, 5))
 
         plt.subplot(131)
         plt.title('Training and Testing Loss value over epochs')
-        plt.plot(np.arange(10) + 1, train_losses, label='Training Loss')
-        plt.plot(np.arange(10) + 1, test_losses, label='Test Loss')
+        plt.plot(epochs, train_losses, label='Training Loss')
+        plt.plot(epochs, test_losses, label='Test Loss')
         plt.legend()
 
         plt.subplot(132)
         plt.title('Train Accuracy value over epochs')
-        plt.plot(np.arange(10) + 1, train_accuracies, label='Training Accuracy')
-        plt.plot(np.arange(10) + 1, test_accuracies, label='Test Accuracy')
+        plt.plot(epochs, train_accuracies, label='Training Accuracy')
+        plt.plot(epochs, test_accuracies, label='Test Accuracy')
         plt.legend()
 
         plt.subplot(133)
         plt.title('Time in Seconds per Epoch')
-        plt.plot(np.arange(10) + 1, time_per_epoch)
+        plt.plot(epochs, time_per_epoch)
 
         plt.show()
     
 
+def train_model(rank, jobs):
+    """
+    Train, visualize and save one of the spot classification models.
+
+    Used as the worker for torch.multiprocessing.spawn, so each job can run in its own process.
+    With several GPUs available, each job is placed on its own GPU.
+
+    Args:
+    - rank (int): Index of the job to run.
+    - jobs (list): Tuples of (model class, data directory, data type, save path).
+    """
+    model_class, data_dir, dtype, save_path = jobs[rank]
+    if torch.cuda.device_count() > 1:
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+
+    cnn_model = model_class()
+    cnn_classifier = Classifier(cnn_model.model, data_dir, dtype)
+    cnn_classifier.train()
+    cnn_classifier.visualize_predictions(cnn_classifier.test_loader)
+    cnn_classifier.save_model(save_path)
+
+
 def train_models():
     """
     Train and save models for station and train spot classification.
 
     Creates instances of StationsCNN and TrainsCNN models, trains them using the Classifier,
-    visualizes predictions, and saves the trained models.
+    visualizes predictions, and saves the trained models. The two models share no state, so
+    on CUDA they are trained in parallel processes.
 
     """
-    station_cnn_model = StationsCNN()
-    station_dir = 'test_train_data/station_data'
-    station_cnn_classifier = Classifier(station_cnn_model.model, station_dir, 'station')
-    station_cnn_classifier.train()
-    station_cnn_classifier.visualize_predictions(station_cnn_classifier.test_loader)
-    
-    station_path = 'models/station_spot_classifiers/trained_station_model_07.pth'
-    station_cnn_classifier.save_model(station_path)
-
-    train_cnn_model = TrainsCNN()
-    train_dir = 'test_train_data/train_data'
-    train_cnn_classifier = Classifier(train_cnn_model.model, train_dir, 'train')
-    train_cnn_classifier.train()
-    train_cnn_classifier.visualize_predictions(train_cnn_classifier.test_loader)
-    
-    train_path = 'models/train_spot_classifiers/trained_train_model_08.pth'
-    train_cnn_classifier.save_model(train_path)
+    jobs = [
+        (StationsCNN, 'test_train_data/station_data', 'station',
+         'models/station_spot_classifiers/trained_station_model_07.pth'),
+        (TrainsCNN, 'test_train_data/train_data', 'train',
+         'models/train_spot_classifiers/trained_train_model_08.pth'),
+    ]
+
+    if torch.cuda.is_available():
+        mp.spawn(train_model, args=(jobs,), nprocs=len(jobs))
+    else:
+        for rank in range(len(jobs)):
+            train_model(rank, jobs)
 
     
 if __name__ == "__main__":
@@ -29,11 +29,12 @@ class TicketSelectionWindow:
         frame.pack(padx=10, pady=10)
 
         self.checkbox_vars = [tk.BooleanVar() for _ in range(len(self.dest_tickets))]
+        self.ticket_labels = sorted(self.dest_tickets)
 
         # Set the number of checkboxes to display in each row
         CHECKBOXES_PER_ROW = 3
 
-        for i, ticket in enumerate(sorted(self.dest_tickets)):
+        for i, ticket in enumerate(self.ticket_labels):
             # Calculate row and column for each checkbox
             row = i // CHECKBOXES_PER_ROW
             col = i % CHECKBOXES_PER_ROW
@@ -41,23 +42,18 @@ class TicketSelectionWindow:
             checkbox = tk.Checkbutton(frame, text=ticket, variable=self.checkbox_vars[i], onvalue=True, offvalue=False)
             checkbox.grid(row=row, column=col, sticky=tk.W)
 
-        # Create a frame specifically for the Checkbuttons
-        self.checkbox_frame = frame
-
         # Button to submit the selected tickets
         self.submit_button = tk.Button(self.selection_window, text="Submit", command=self.submit_tickets)
         self.submit_button.pack(pady=10)
 
     def submit_tickets(self):
-        # Use the frame specifically created for the Checkbuttons
-        children_except_button = [child for child in self.checkbox_frame.winfo_children() if child != self.submit_button]
-
-        selected_checkboxes = [checkbox for checkbox, var in zip(children_except_button, self.checkbox_vars) if isinstance(checkbox, tk.Checkbutton) and var.get()]
-        if len(selected_checkboxes) != self.ticket_count:
+        # Checkbox i was created for self.ticket_labels[i]
+        selected_indices = [i for i, var in enumerate(self.checkbox_vars) if var.get()]
+        if len(selected_indices) != self.ticket_count:
             messagebox.showerror("Error", f"Please select exactly {self.ticket_count} tickets.")
             return
 
-        selected_tickets = {checkbox.cget("text") for checkbox in selected_checkboxes}
+        selected_tickets = {self.ticket_labels[i] for i in selected_indices}
 
 
         # Update the selected_tickets attribute
@@ -75,7 +71,7 @@ class TicketToRideScorerGUI:
         self.colors = ['red', 'green', 'blue', 'black', 'yellow']
 
         all_tickets_df = pd.read_csv('game_data/destinations.csv')
-        self.tickets = set(zip(all_tickets_df['Source'], all_tickets_df['Target']))
+        self.tickets = {tuple(ticket) for ticket in all_tickets_df[['Source', 'Target']].to_numpy()}
 
         self.game_tickets = {}
         self.image_path = ''
@@ -159,8 +155,9 @@ class TicketToRideScorerGUI:
             # Get the selected tickets after the window is closed
             selected_tickets = ticket_selection.get_selected_tickets()
 
+            # The scorer expects tickets as "Source Target" strings
             for tick in selected_tickets:
-                self.game_tickets[color].append(tick)
+                self.game_tickets[color].append(' '.join(tick))
 
             self.tickets -= selected_tickets
             print(f"{color} selected tickets:", selected_tickets)